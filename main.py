@@ -1,18 +1,34 @@
 from fastapi import FastAPI, Request, HTTPException, Response
-from fastapi.responses import HTMLResponse, FileResponse, RedirectResponse, JSONResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, ORJSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
 from dotenv import load_dotenv
+from cachetools import TTLCache
+import numpy as np
 import uvicorn
+import asyncio
+import time
 import os
-import json
+import re
+import gzip
+import orjson
+import hashlib
+import secrets
+import tempfile
+import mimetypes
+from collections import defaultdict
+import aiofiles
+import aiosqlite
+import httpx
 import openai
-import requests
-import io
 
-app = FastAPI(title="Portal Synthetica")
+app = FastAPI(title="Portal Synthetica", default_response_class=ORJSONResponse)
+
+# Comprimir respostas dinâmicas (HTML/JSON comprimem 5-10x)
+app.add_middleware(GZipMiddleware, minimum_size=500, compresslevel=5)
 
 # Configurar CORS
 app.add_middleware(
@@ -32,6 +48,12 @@ if not chave_openai:
 
 openai.api_key = chave_openai
 
+# Cliente OpenAI único: reaproveita o pool de conexões entre requisições
+OPENAI = openai.AsyncOpenAI(api_key=chave_openai)
+
+# Modelo do Buddy, configurável sem mexer no código
+BUDDY_MODEL = os.getenv("BUDDY_MODEL", "gpt-4o-mini")
+
 
 class Product(BaseModel):
     title: str
@@ -53,8 +75,12 @@ class BuddyRequest(BaseModel):
     history: Optional[List[Dict[str, Any]]] = []
     voice_enabled: Optional[bool] = False
 
-# Arquivo para persistência de dados
+# Arquivo legado (JSON) usado apenas para migração e banco SQLite atual
 DATA_FILE = "products_data.json"
+DB_FILE = "products.db"
+
+# Colunas da tabela de produtos, na ordem do schema
+PRODUCT_COLUMNS = ("id", "title", "description", "category", "price", "image", "brand", "model", "year")
 
 # Base de conhecimento sobre IA na arte e avanços tecnológicos
 base_conhecimento = [
@@ -64,41 +90,134 @@ base_conhecimento = [
     "IA criativa pode colaborar com artistas, oferecendo sugestões de composição, paletas de cor ou até mesmo criando música original."
 ]
 
-# Função para carregar produtos do arquivo
+# Função para carregar produtos do arquivo JSON legado (só usada na migração)
 def load_products():
     if os.path.exists(DATA_FILE):
         try:
-            with open(DATA_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                return data.get("products", []), data.get("counter", 1)
+            with open(DATA_FILE, "rb") as f:
+                data = orjson.loads(f.read())
+                return data.get("products", [])
         except Exception as e:
             print(f"Erro ao carregar produtos: {e}")
-    return [], 1
-
-# Função para salvar produtos no arquivo
-def save_products(products, counter):
+    return []
+
+# Conexão SQLite compartilhada (aberta no startup)
+_db: Optional[aiosqlite.Connection] = None
+
+# Converte uma linha da tabela em dict de produto
+def _row_to_product(row):
+    return dict(zip(PRODUCT_COLUMNS, row))
+
+# Insere um produto; id None deixa o SQLite atribuir o próximo
+async def _insert_product(product: dict):
+    cursor = await _db.execute(
+        "INSERT INTO products(id, title, description, category, price, image, brand, model, year) "
+        "VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        tuple(product.get(col) for col in PRODUCT_COLUMNS)
+    )
+    return cursor.lastrowid
+
+# Insere a carga inicial se a tabela ainda estiver vazia. BEGIN IMMEDIATE
+# serializa os workers no primeiro boot: só quem pega o write lock e ainda
+# vê a tabela vazia insere; os demais reconferem o count e desistem
+async def _seed_products_once(produtos) -> bool:
+    if not produtos:
+        return False
+    await _db.execute("BEGIN IMMEDIATE")
     try:
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump({"products": products, "counter": counter}, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"Erro ao salvar produtos: {e}")
-
-# Inicializar banco de dados
-products_db, product_id_counter = load_products()
+        async with _db.execute("SELECT COUNT(*) FROM products") as cursor:
+            total = (await cursor.fetchone())[0]
+        if total > 0:
+            await _db.rollback()
+            return False
+        for product in produtos:
+            await _insert_product(product)
+        await _db.commit()
+        return True
+    except Exception:
+        await _db.rollback()
+        raise
+
+# Abre o banco, cria o schema e migra o JSON legado uma única vez
+async def _init_db():
+    global _db
+    _db = await aiosqlite.connect(DB_FILE)
+    await _db.execute("PRAGMA journal_mode=WAL")
+    await _db.execute(
+        "CREATE TABLE IF NOT EXISTS products("
+        "id INTEGER PRIMARY KEY, title TEXT, description TEXT, category TEXT, "
+        "price REAL, image TEXT, brand TEXT, model TEXT, year INTEGER)"
+    )
+    await _db.execute(
+        "CREATE TABLE IF NOT EXISTS speech_tokens("
+        "id TEXT PRIMARY KEY, texto TEXT, expira REAL)"
+    )
+    await _db.commit()
+
+    async with _db.execute("SELECT COUNT(*) FROM products") as cursor:
+        total = (await cursor.fetchone())[0]
+    if total == 0:
+        await _seed_products_once(load_products())
+
+# Stopwords que só geram falsos positivos na busca (sem filtro por
+# tamanho: termos curtos do domínio, como "ia", precisam continuar válidos)
+_STOPWORDS = {
+    "a", "o", "e", "é", "as", "os", "um", "de", "da", "do", "das", "dos",
+    "em", "no", "na", "nos", "nas", "ao", "aos", "à", "às", "se", "seu",
+    "sua", "que", "com", "para", "uma", "por", "como", "mais", "tem",
+    "ser", "sobre", "até", "mesmo"
+}
+
+# Tokeniza um texto em palavras minúsculas relevantes para a busca
+def _tokenizar(texto: str):
+    return [tok for tok in re.findall(r"\w+", texto.lower()) if tok not in _STOPWORDS]
+
+# Índice invertido (token -> ids de documentos), construído uma única vez
+def _build_index(docs):
+    index = defaultdict(set)
+    for i, doc in enumerate(docs):
+        for token in _tokenizar(doc):
+            index[token].add(i)
+    return index
+
+INDEX = _build_index(base_conhecimento)
 
 # Função RAG rudimentar: busca conteúdos relevantes com base na preferência do usuário
 def buscar_conteudo_relevante(preferencia_usuario: str) -> str:
-    resultados = [doc for doc in base_conhecimento if any(palavra.lower() in doc.lower() for palavra in preferencia_usuario.split())]
-    return "\n".join(resultados) if resultados else "Nenhuma informação relevante encontrada."
-
-# Simula integração com APIs externas (ex: clima)
-def get_weather(latitude: float, longitude: float) -> float:
+    tokens = _tokenizar(preferencia_usuario)
+    matched = set().union(*(INDEX.get(tok, set()) for tok in tokens)) if tokens else set()
+    if not matched:
+        return "Nenhuma informação relevante encontrada."
+    return "\n".join(base_conhecimento[i] for i in sorted(matched))
+
+# Saudações e despedidas que não precisam de contexto da base
+_SMALL_TALK_RE = re.compile(r"^\s*(oi|olá|ola|bom dia|boa tarde|boa noite|obrigad[oa]|tchau)", re.I)
+
+# Mensagens curtas ou de cortesia não justificam inflar o prompt com RAG
+def _should_retrieve(mensagem: str) -> bool:
+    if len(mensagem.split()) < 4:
+        return False
+    return not _SMALL_TALK_RE.match(mensagem)
+
+# Cliente HTTP assíncrono compartilhado (pool de conexões criado no startup)
+_httpx_client: Optional[httpx.AsyncClient] = None
+
+# Cache de clima: a temperatura muda devagar, 10 minutos por coordenada
+_weather_cache = TTLCache(maxsize=256, ttl=600)
+
+# Integração com APIs externas (ex: clima), sem bloquear o event loop
+async def get_weather(latitude: float, longitude: float) -> float:
+    chave = (round(latitude, 2), round(longitude, 2))
+    temperatura = _weather_cache.get(chave)
+    if temperatura is not None:
+        return temperatura
     try:
-        response = requests.get(
+        response = await _httpx_client.get(
             f"https://api.open-meteo.com/v1/forecast?latitude={latitude}&longitude={longitude}&current=temperature_2m"
         )
-        data = response.json()
-        return data['current']['temperature_2m']
+        temperatura = response.json()['current']['temperature_2m']
+        _weather_cache[chave] = temperatura
+        return temperatura
     except Exception as e:
         print(f"Erro ao obter clima: {e}")
         return 25.0  # Valor padrão em caso de erro
@@ -118,242 +237,607 @@ tools = [{
             "required": ["latitude", "longitude"]
         }
     }
+}, {
+    "type": "function",
+    "function": {
+        "name": "search_knowledge_base",
+        "description": "Busca conteúdos sobre IA, arte e tecnologia na base de conhecimento.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "query": {"type": "string"}
+            },
+            "required": ["query"]
+        }
+    }
 }]
 
-# Função para gerar áudio a partir de texto usando a API da OpenAI
-async def generate_speech(text: str):
+# Executa a ferramenta pedida pelo modelo e devolve o resultado como texto
+async def _dispatch_tool(tool_call) -> str:
+    nome = tool_call["function"]["name"]
+    args = orjson.loads(tool_call["function"]["arguments"])
+    if nome == "get_weather":
+        return str(await get_weather(args["latitude"], args["longitude"]))
+    if nome == "search_knowledge_base":
+        return buscar_conteudo_relevante(args["query"])
+    return f"Ferramenta desconhecida: {nome}"
+
+# Cache de respostas do Buddy: requisições idênticas não voltam à OpenAI
+_response_cache = TTLCache(maxsize=1024, ttl=1800)
+_cache_stats = {"hits": 0, "misses": 0}
+
+# Requisições idênticas em andamento: todas aguardam a mesma chamada
+_inflight: Dict[str, asyncio.Future] = {}
+
+# Gera uma chave determinística para o payload enviado à OpenAI
+def _cache_key(model, messages, tools):
+    payload = orjson.dumps({"model": model, "messages": messages, "tools": tools}, option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(payload).hexdigest()
+
+# Cache semântico: paráfrases da mesma pergunta reutilizam respostas já geradas
+SEMANTIC_CACHE_FILE = "semantic_cache.npz"
+SEMANTIC_THRESHOLD = 0.92
+SEMANTIC_CACHE_MAX = 1024
+_semantic_embeddings = np.empty((0, 1536), dtype=np.float32)
+_semantic_responses = []
+
+# Carrega o cache semântico do disco, se existir
+def _load_semantic_cache():
+    global _semantic_embeddings, _semantic_responses
+    if os.path.exists(SEMANTIC_CACHE_FILE):
+        try:
+            data = np.load(SEMANTIC_CACHE_FILE, allow_pickle=True)
+            _semantic_embeddings = data["embeddings"]
+            _semantic_responses = list(data["responses"])
+        except Exception as e:
+            print(f"Erro ao carregar cache semântico: {e}")
+
+# Persiste o cache semântico no disco (temp + os.replace: escrita atômica,
+# mesmo com vários workers gravando o mesmo arquivo)
+def _save_semantic_cache():
     try:
-        client = openai.OpenAI(api_key=chave_openai)
-        response = client.audio.speech.create(
+        tmp_file = f"semantic_cache.{os.getpid()}.tmp.npz"
+        np.savez(
+            tmp_file,
+            embeddings=_semantic_embeddings,
+            responses=np.array(_semantic_responses, dtype=object)
+        )
+        os.replace(tmp_file, SEMANTIC_CACHE_FILE)
+    except Exception as e:
+        print(f"Erro ao salvar cache semântico: {e}")
+
+# Gera o embedding normalizado da mensagem do usuário
+async def _embed_message(text: str):
+    response = await OPENAI.embeddings.create(model="text-embedding-3-small", input=text)
+    emb = np.asarray(response.data[0].embedding, dtype=np.float32)
+    return emb / np.linalg.norm(emb)
+
+# Busca a resposta mais parecida no cache semântico (cosseno >= limiar)
+def _semantic_lookup(query_emb):
+    if not _semantic_responses:
+        return None
+    scores = _semantic_embeddings @ query_emb
+    best = int(scores.argmax())
+    if scores[best] >= SEMANTIC_THRESHOLD:
+        return _semantic_responses[best]
+    return None
+
+# Adiciona um novo par (embedding, resposta) ao cache semântico, limitado
+# às entradas mais recentes; o dump vai para uma thread fora do event loop
+async def _semantic_store(query_emb, resposta: str):
+    global _semantic_embeddings, _semantic_responses
+    _semantic_embeddings = np.vstack([_semantic_embeddings, query_emb[None, :]])
+    _semantic_responses.append(resposta)
+    if len(_semantic_responses) > SEMANTIC_CACHE_MAX:
+        _semantic_embeddings = _semantic_embeddings[-SEMANTIC_CACHE_MAX:]
+        _semantic_responses = _semantic_responses[-SEMANTIC_CACHE_MAX:]
+    await asyncio.to_thread(_save_semantic_cache)
+
+_load_semantic_cache()
+
+# Textos de respostas recentes, endereçados por um token curto na URL;
+# ficam no SQLite para que qualquer worker consiga resolver o token
+SPEECH_TOKEN_TTL = 600
+
+async def _store_speech_token(texto: str) -> str:
+    sid = secrets.token_urlsafe(8)
+    agora = time.time()
+    await _db.execute("DELETE FROM speech_tokens WHERE expira < ?", (agora,))
+    await _db.execute(
+        "INSERT INTO speech_tokens(id, texto, expira) VALUES(?, ?, ?)",
+        (sid, texto, agora + SPEECH_TOKEN_TTL)
+    )
+    await _db.commit()
+    return sid
+
+async def _load_speech_token(sid: str) -> Optional[str]:
+    async with _db.execute(
+        "SELECT texto FROM speech_tokens WHERE id = ? AND expira > ?", (sid, time.time())
+    ) as cursor:
+        row = await cursor.fetchone()
+    return row[0] if row else None
+
+# Cache de áudio TTS em disco: a mesma resposta não é regerada
+TTS_CACHE_DIR = "tts_cache"
+TTS_CACHE_MAX = 256
+
+def _tts_cache_path(text: str) -> str:
+    return os.path.join(TTS_CACHE_DIR, hashlib.sha256(text.encode("utf-8")).hexdigest() + ".mp3")
+
+# Remove os arquivos menos usados quando o cache passa do limite
+def _prune_tts_cache():
+    try:
+        arquivos = [os.path.join(TTS_CACHE_DIR, nome) for nome in os.listdir(TTS_CACHE_DIR)]
+        if len(arquivos) <= TTS_CACHE_MAX:
+            return
+        arquivos.sort(key=os.path.getmtime)
+        for caminho in arquivos[:len(arquivos) - TTS_CACHE_MAX]:
+            os.remove(caminho)
+    except Exception as e:
+        print(f"Erro ao limpar cache de TTS: {e}")
+
+# Gera (ou relê do cache) o áudio em pedaços, sem bufferizar o MP3 inteiro
+async def _tts_chunks(text: str):
+    cache_path = _tts_cache_path(text)
+    if os.path.exists(cache_path):
+        os.utime(cache_path)  # marca como usado recentemente
+        async with aiofiles.open(cache_path, "rb") as f:
+            while True:
+                chunk = await f.read(4096)
+                if not chunk:
+                    break
+                yield chunk
+        return
+
+    os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+    # Nome temporário único: gerações concorrentes do mesmo texto não
+    # escrevem no mesmo arquivo (a última promovida vence no os.replace)
+    fd, tmp_path = tempfile.mkstemp(dir=TTS_CACHE_DIR, suffix=".tmp")
+    try:
+        async with OPENAI.audio.speech.with_streaming_response.create(
             model="gpt-4o-mini-tts",
             voice="echo",
             input=text,
             instructions="Responda de forma gentil, lembrando que você é um robo e vive em 2047, mas fale como um garato sapeca.",
-        )
-        
-        # Converter a resposta em bytes para streaming
-        audio_data = io.BytesIO()
-        for chunk in response.iter_bytes(chunk_size=4096):
-            audio_data.write(chunk)
-        
-        audio_data.seek(0)
-        return audio_data
+        ) as response:
+            with os.fdopen(fd, "wb") as f:
+                async for chunk in response.iter_bytes(4096):
+                    f.write(chunk)
+                    yield chunk
+        os.replace(tmp_path, cache_path)
+        _prune_tts_cache()
     except Exception as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
         print(f"Erro ao gerar áudio: {e}")
-        raise HTTPException(status_code=500, detail=f"Erro ao gerar áudio: {str(e)}")
+        raise
+
+# Listagem já serializada; os dados vêm validados do banco, então não há
+# motivo para o Pydantic revalidar o catálogo inteiro a cada GET
+_products_list_cache: Optional[bytes] = None
+_products_data_version: Optional[int] = None
+
+def _invalidate_products_cache():
+    global _products_list_cache
+    _products_list_cache = None
+
+# PRAGMA data_version muda quando OUTRA conexão grava o banco
+async def _data_version() -> int:
+    async with _db.execute("PRAGMA data_version") as cursor:
+        return (await cursor.fetchone())[0]
 
 # Endpoints para o CRUD de produtos
-@app.get("/api/products", response_model=List[ProductInDB])
+@app.get("/api/products")
 async def get_products():
-    return products_db
+    global _products_list_cache, _products_data_version
+
+    # Invalidação local cobre mutações deste worker; o data_version
+    # detecta escritas feitas pelos demais workers
+    versao = await _data_version()
+    if _products_list_cache is None or versao != _products_data_version:
+        async with _db.execute("SELECT * FROM products ORDER BY id") as cursor:
+            rows = await cursor.fetchall()
+        _products_list_cache = orjson.dumps([_row_to_product(row) for row in rows])
+        _products_data_version = versao
+    return Response(_products_list_cache, media_type="application/json")
 
 @app.get("/api/products/{product_id}", response_model=ProductInDB)
 async def get_product(product_id: int):
-    for product in products_db:
-        if product["id"] == product_id:
-            return product
-    raise HTTPException(status_code=404, detail="Produto não encontrado")
+    async with _db.execute("SELECT * FROM products WHERE id = ?", (product_id,)) as cursor:
+        row = await cursor.fetchone()
+    if row is None:
+        raise HTTPException(status_code=404, detail="Produto não encontrado")
+    return _row_to_product(row)
 
 @app.post("/api/products", response_model=ProductInDB)
 async def create_product(product: Product):
-    global product_id_counter, products_db
-    
     product_dict = product.dict()
-    product_dict["id"] = product_id_counter
-    product_id_counter += 1
-    
-    products_db.append(product_dict)
-    
-    # Salvar no arquivo
-    save_products(products_db, product_id_counter)
-    
+    product_dict["id"] = await _insert_product(product_dict)
+    await _db.commit()
+    _invalidate_products_cache()
     return product_dict
 
 @app.put("/api/products/{product_id}", response_model=ProductInDB)
 async def update_product(product_id: int, product: Product):
-    global products_db
-    
-    for i, p in enumerate(products_db):
-        if p["id"] == product_id:
-            product_dict = product.dict()
-            product_dict["id"] = product_id
-            products_db[i] = product_dict
-            
-            # Salvar no arquivo
-            save_products(products_db, product_id_counter)
-            
-            return product_dict
-    raise HTTPException(status_code=404, detail="Produto não encontrado")
+    product_dict = product.dict()
+    cursor = await _db.execute(
+        "UPDATE products SET title=?, description=?, category=?, price=?, image=?, brand=?, model=?, year=? "
+        "WHERE id=?",
+        tuple(product_dict.get(col) for col in PRODUCT_COLUMNS[1:]) + (product_id,)
+    )
+    await _db.commit()
+    if cursor.rowcount == 0:
+        raise HTTPException(status_code=404, detail="Produto não encontrado")
+
+    _invalidate_products_cache()
+    product_dict["id"] = product_id
+    return product_dict
 
 @app.delete("/api/products/{product_id}")
 async def delete_product(product_id: int):
-    global products_db
-    
-    for i, product in enumerate(products_db):
-        if product["id"] == product_id:
-            products_db.pop(i)
-            
-            # Salvar no arquivo
-            save_products(products_db, product_id_counter)
-            
-            return {"message": "Produto excluído com sucesso"}
-    
-    raise HTTPException(status_code=404, detail="Produto não encontrado")
-
-# Rota para o Buddy
-@app.post("/api/buddy")
-async def process_buddy_request(request: BuddyRequest):
+    cursor = await _db.execute("DELETE FROM products WHERE id = ?", (product_id,))
+    await _db.commit()
+    if cursor.rowcount == 0:
+        raise HTTPException(status_code=404, detail="Produto não encontrado")
+
+    _invalidate_products_cache()
+    return {"message": "Produto excluído com sucesso"}
+
+# Formata um evento SSE
+def _sse(data) -> str:
+    return f"data: {orjson.dumps(data).decode()}\n\n"
+
+# Junta fragmentos de tool_calls que chegam espalhados pelo stream
+def _accumulate_tool_calls(acc, deltas):
+    for delta in deltas:
+        while len(acc) <= delta.index:
+            acc.append({"id": "", "type": "function", "function": {"name": "", "arguments": ""}})
+        tool_call = acc[delta.index]
+        if delta.id:
+            tool_call["id"] = delta.id
+        if delta.function and delta.function.name:
+            tool_call["function"]["name"] = delta.function.name
+        if delta.function and delta.function.arguments:
+            tool_call["function"]["arguments"] += delta.function.arguments
+
+# Gera a resposta do Buddy como eventos SSE, token a token
+async def _buddy_stream(user_message, history, messages, cache_key, voice_enabled):
     try:
-        user_message = request.message
-        context = request.context
-        history = request.history
-        voice_enabled = request.voice_enabled
-        
-        if not user_message:
-            raise HTTPException(status_code=400, detail="Mensagem vazia")
-        
-        # Se não houver contexto fornecido, busque-o
-        if not context:
-            context = buscar_conteudo_relevante(user_message)
-        
-        # Preparar mensagens para a API da OpenAI
-        messages = []
-        
-        # Adicionar histórico se fornecido
-        if history:
-            messages.extend(history)
-        else:
-            # Mensagem do sistema
-            messages.append({
-                "role": "system", 
-                "content": "Você é Buddy, um agente de IA do ano 2047 que recomenda conteúdos personalizados sobre arte, cultura e tecnologia."
-            })
-            
-            # Adicionar a mensagem do usuário com contexto
-            messages.append({
-                "role": "user", 
-                "content": f"Oi Buddy! {user_message}\n\nContexto:\n{context}"
-            })
-        
-        # Fazer a chamada para a API da OpenAI
-        client = openai.OpenAI(api_key=chave_openai)
-        completion = client.chat.completions.create(
-            model="gpt-3.5-turbo",  # Você pode mudar para gpt-4 se tiver acesso
-            messages=messages,
-            tools=tools
-        )
-        
-        response_message = completion.choices[0].message
-        
-        # Se houver chamada de função...
-        if hasattr(response_message, 'tool_calls') and response_message.tool_calls:
-            tool_call = response_message.tool_calls[0]
-            args = json.loads(tool_call.function.arguments)
-            
-            # Executa função de clima
-            resultado = get_weather(args["latitude"], args["longitude"])
-            
-            # Atualiza histórico
-            messages.append(response_message.model_dump())
-            messages.append({
-                "role": "tool",
-                "tool_call_id": tool_call.id,
-                "content": str(resultado)
-            })
-            
-            # Segunda chamada com o resultado
-            completion = client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=messages
-            )
-            resposta_final = completion.choices[0].message.content
+        resposta_final = _response_cache.get(cache_key)
+        query_emb = None
+
+        if resposta_final is not None:
+            _cache_stats["hits"] += 1
+            yield _sse({"delta": resposta_final})
         else:
-            resposta_final = response_message.content
-        
-        # Se a voz estiver habilitada, gerar o áudio
+            # Sem hit exato, tentar o cache semântico (só sem histórico,
+            # pois a resposta depende apenas da mensagem do usuário).
+            # É otimização: se o embedding falhar, seguimos sem cache
+            if not history:
+                try:
+                    query_emb = await _embed_message(user_message)
+                    resposta_final = _semantic_lookup(query_emb)
+                except Exception as e:
+                    print(f"Erro no cache semântico: {e}")
+                    query_emb = None
+
+            if resposta_final is not None:
+                _cache_stats["hits"] += 1
+                yield _sse({"delta": resposta_final})
+
+        usou_tools = False
+        if resposta_final is None:
+            fut = _inflight.get(cache_key)
+            if fut is not None:
+                # Requisição idêntica em andamento: aguardar o mesmo resultado
+                resposta_final = await fut
+                _cache_stats["hits"] += 1
+                yield _sse({"delta": resposta_final})
+
+        if resposta_final is None:
+            fut = asyncio.get_running_loop().create_future()
+            _inflight[cache_key] = fut
+            try:
+                _cache_stats["misses"] += 1
+
+                # Fazer a chamada para a API da OpenAI em streaming
+                stream = await OPENAI.chat.completions.create(
+                    model=BUDDY_MODEL,
+                    messages=messages,
+                    tools=tools,
+                    stream=True
+                )
+
+                partes = []
+                tool_calls = []
+                async for chunk in stream:
+                    delta = chunk.choices[0].delta if chunk.choices else None
+                    if delta is None:
+                        continue
+                    if delta.content:
+                        partes.append(delta.content)
+                        yield _sse({"delta": delta.content})
+                    if delta.tool_calls:
+                        _accumulate_tool_calls(tool_calls, delta.tool_calls)
+
+                # Se houver chamada de função...
+                if tool_calls:
+                    usou_tools = True
+
+                    # Executa todas as ferramentas pedidas em paralelo
+                    resultados = await asyncio.gather(
+                        *[_dispatch_tool(tool_call) for tool_call in tool_calls]
+                    )
+
+                    # Atualiza histórico
+                    messages.append({"role": "assistant", "content": None, "tool_calls": tool_calls})
+                    for tool_call, resultado in zip(tool_calls, resultados):
+                        messages.append({
+                            "role": "tool",
+                            "tool_call_id": tool_call["id"],
+                            "content": resultado
+                        })
+
+                    # Segunda chamada com o resultado, também em streaming
+                    stream = await OPENAI.chat.completions.create(
+                        model=BUDDY_MODEL,
+                        messages=messages,
+                        stream=True
+                    )
+                    partes = []
+                    async for chunk in stream:
+                        delta = chunk.choices[0].delta if chunk.choices else None
+                        if delta and delta.content:
+                            partes.append(delta.content)
+                            yield _sse({"delta": delta.content})
+
+                resposta_final = "".join(partes)
+
+                # Guardar no cache apenas respostas sem tools (o clima muda)
+                if resposta_final and not usou_tools:
+                    _response_cache[cache_key] = resposta_final
+                    if query_emb is not None:
+                        await _semantic_store(query_emb, resposta_final)
+
+                fut.set_result(resposta_final)
+            except Exception as e:
+                if not fut.done():
+                    fut.set_exception(e)
+                raise
+            finally:
+                # Cancelamento (cliente desconectou no meio do stream) não
+                # passa pelo except acima; sem resolver o future aqui, os
+                # seguidores coalescidos ficariam pendurados para sempre
+                if not fut.done():
+                    fut.cancel()
+                _inflight.pop(cache_key, None)
+
+        # Se a voz estiver habilitada, registrar o texto sob um token curto
+        # (evita reenviar a resposta inteira, com escaping quebrado, na URL)
         audio_url = None
-        if voice_enabled:
-            audio_url = "/api/buddy/speech?text=" + resposta_final.replace(" ", "%20")
-        
-        return JSONResponse(content={"response": resposta_final, "audio_url": audio_url})
-    
+        if voice_enabled and resposta_final:
+            sid = await _store_speech_token(resposta_final)
+            audio_url = f"/api/buddy/speech/{sid}"
+
+        # Evento final com a resposta completa
+        yield _sse({"response": resposta_final, "audio_url": audio_url})
+        yield "data: [DONE]\n\n"
+
     except Exception as e:
         print(f"Erro ao processar requisição: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        yield _sse({"error": str(e)})
 
-# Endpoint para gerar áudio a partir de texto
+# Rota para o Buddy
+@app.post("/api/buddy")
+async def process_buddy_request(request: BuddyRequest):
+    user_message = request.message
+    context = request.context
+    history = request.history
+    voice_enabled = request.voice_enabled
+
+    if not user_message:
+        raise HTTPException(status_code=400, detail="Mensagem vazia")
+
+    # Se não houver contexto fornecido, busque-o (a menos que seja conversa
+    # curta; o modelo ainda pode pedir a base via tool search_knowledge_base)
+    if not context and _should_retrieve(user_message):
+        context = buscar_conteudo_relevante(user_message)
+
+    # Preparar mensagens para a API da OpenAI
+    messages = []
+
+    # Adicionar histórico se fornecido
+    if history:
+        messages.extend(history)
+    else:
+        # Mensagem do sistema
+        messages.append({
+            "role": "system", 
+            "content": "Você é Buddy, um agente de IA do ano 2047 que recomenda conteúdos personalizados sobre arte, cultura e tecnologia."
+        })
+        
+        # Adicionar a mensagem do usuário (com contexto, se houver)
+        conteudo = f"Oi Buddy! {user_message}"
+        if context:
+            conteudo += f"\n\nContexto:\n{context}"
+        messages.append({"role": "user", "content": conteudo})
+
+    cache_key = _cache_key(BUDDY_MODEL, messages, tools)
+
+    # content-encoding: identity impede o GZipMiddleware de bufferizar os
+    # deltas no compressor; cada token deve chegar ao cliente na hora
+    return StreamingResponse(
+        _buddy_stream(user_message, history, messages, cache_key, voice_enabled),
+        media_type="text/event-stream",
+        headers={"content-encoding": "identity"}
+    )
+
+# Endpoint com estatísticas do cache de respostas do Buddy
+@app.get("/api/buddy/cache/stats")
+async def get_cache_stats():
+    return {
+        "hits": _cache_stats["hits"],
+        "misses": _cache_stats["misses"],
+        "size": len(_response_cache)
+    }
+
+# Cache em memória dos arquivos do frontend: (corpo, etag, content-type)
+STATIC_MAX_BYTES = 256 * 1024
+_static_cache = {}
+
+# Lê os arquivos do frontend uma única vez para servir da memória
+def _load_static_cache():
+    if not os.path.isdir("frontend"):
+        return
+    for raiz, _dirs, arquivos in os.walk("frontend"):
+        for nome in arquivos:
+            caminho = os.path.join(raiz, nome)
+            if os.path.getsize(caminho) > STATIC_MAX_BYTES:
+                continue
+            with open(caminho, "rb") as f:
+                corpo = f.read()
+            etag = hashlib.md5(corpo).hexdigest()
+            media_type = mimetypes.guess_type(nome)[0] or "application/octet-stream"
+
+            # Pré-comprimir quando vale a pena (texto grande o suficiente)
+            corpo_gz = None
+            if len(corpo) >= 500:
+                comprimido = gzip.compress(corpo, 5)
+                if len(comprimido) < len(corpo):
+                    corpo_gz = comprimido
+
+            rel = os.path.relpath(caminho, "frontend").replace(os.sep, "/")
+            _static_cache[rel] = (corpo, corpo_gz, etag, media_type)
+
+# Serve um arquivo do cache em memória, com suporte a 304 via ETag
+def _serve_cached(request: Request, path: str):
+    cached = _static_cache.get(path)
+    if cached is None:
+        return None
+    corpo, corpo_gz, etag, media_type = cached
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304)
+
+    headers = {"etag": etag, "cache-control": "public, max-age=300", "vary": "accept-encoding"}
+    if corpo_gz is not None and "gzip" in request.headers.get("accept-encoding", ""):
+        headers["content-encoding"] = "gzip"
+        return Response(corpo_gz, media_type=media_type, headers=headers)
+    return Response(corpo, media_type=media_type, headers=headers)
+
+# Endpoint para gerar áudio de uma resposta recente do Buddy
+@app.get("/api/buddy/speech/{speech_id}")
+async def get_speech_by_id(speech_id: str):
+    texto = await _load_speech_token(speech_id)
+    if texto is None:
+        raise HTTPException(status_code=404, detail="Áudio não encontrado ou expirado")
+    # MP3 já é comprimido: identity evita passar o stream pelo gzip
+    return StreamingResponse(
+        _tts_chunks(texto),
+        media_type="audio/mpeg",
+        headers={"cache-control": "public, max-age=86400", "content-encoding": "identity"}
+    )
+
+# Endpoint legado para gerar áudio a partir de texto arbitrário
 @app.get("/api/buddy/speech")
 async def get_speech(text: str):
-    try:
-        audio_data = await generate_speech(text)
-        return StreamingResponse(audio_data, media_type="audio/mpeg")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return StreamingResponse(
+        _tts_chunks(text),
+        media_type="audio/mpeg",
+        headers={"cache-control": "public, max-age=86400", "content-encoding": "identity"}
+    )
 
 # Montar arquivos estáticos - IMPORTANTE: Montar DEPOIS de definir as rotas da API
 app.mount("/static", StaticFiles(directory="frontend"), name="static")
 
 # Rotas para páginas HTML
 @app.get("/", response_class=HTMLResponse)
-async def root():
-    with open("frontend/index.html", "r", encoding="utf-8") as f:
-        return f.read()
+async def root(request: Request):
+    cached = _serve_cached(request, "index.html")
+    if cached is not None:
+        return cached
+    async with aiofiles.open("frontend/index.html", "r", encoding="utf-8") as f:
+        return await f.read()
 
 @app.get("/index.html", response_class=RedirectResponse)
 async def index_redirect():
     return RedirectResponse(url="/")
 
 @app.get("/catalogo", response_class=HTMLResponse)
-async def catalogo():
-    with open("frontend/catalogo.html", "r", encoding="utf-8") as f:
-        return f.read()
+async def catalogo(request: Request):
+    cached = _serve_cached(request, "catalogo.html")
+    if cached is not None:
+        return cached
+    async with aiofiles.open("frontend/catalogo.html", "r", encoding="utf-8") as f:
+        return await f.read()
 
 @app.get("/catalogo.html", response_class=RedirectResponse)
 async def catalogo_redirect():
     return RedirectResponse(url="/catalogo")
 
 @app.get("/distribuidores", response_class=HTMLResponse)
-async def distribuidores():
-    with open("frontend/distribuidores.html", "r", encoding="utf-8") as f:
-        return f.read()
+async def distribuidores(request: Request):
+    cached = _serve_cached(request, "distribuidores.html")
+    if cached is not None:
+        return cached
+    async with aiofiles.open("frontend/distribuidores.html", "r", encoding="utf-8") as f:
+        return await f.read()
 
 @app.get("/distribuidores.html", response_class=RedirectResponse)
 async def distribuidores_redirect():
     return RedirectResponse(url="/distribuidores")
 
 @app.get("/buddy", response_class=HTMLResponse)
-async def buddy():
-    with open("frontend/buddy.html", "r", encoding="utf-8") as f:
-        return f.read()
+async def buddy(request: Request):
+    cached = _serve_cached(request, "buddy.html")
+    if cached is not None:
+        return cached
+    async with aiofiles.open("frontend/buddy.html", "r", encoding="utf-8") as f:
+        return await f.read()
 
 @app.get("/buddy.html", response_class=RedirectResponse)
 async def buddy_redirect():
     return RedirectResponse(url="/buddy")
 
-@app.get("/catalogo", response_class=HTMLResponse)
-async def catalogo():
-    return FileResponse('frontend/catalogo.html')
-
+# O menu nunca muda: serializar uma vez e devolver os bytes prontos
+MENU_BYTES = orjson.dumps({
+    "menu_items": [
+        {"name": "Inicio", "url": "/"},
+        {"name": "Catálogo", "url": "/catalogo"},
+        {"name": "Buddy", "url": "/buddy"},
+        {"name": "Portal", "url": "/portal"},
+        {"name": "Distribuidores", "url": "/distribuidores"}
+    ]
+})
 
 @app.get("/api/menu")
 async def get_menu():
-    return {
-        "menu_items": [
-            {"name": "Inicio", "url": "/"},
-            {"name": "Catálogo", "url": "/catalogo"},
-            {"name": "Buddy", "url": "/buddy"},
-            {"name": "Portal", "url": "/portal"},
-            {"name": "Distribuidores", "url": "/distribuidores"}
-        ]
-    }
+    return Response(
+        MENU_BYTES,
+        media_type="application/json",
+        headers={"cache-control": "public, max-age=3600"}
+    )
 
 # Adicionar alguns produtos de exemplo se o banco de dados estiver vazio
 @app.on_event("startup")
 async def startup_event():
-    global products_db, product_id_counter
-    
+    global _httpx_client
+
+    # Criar o cliente HTTP compartilhado (reaproveita conexões TCP/TLS)
+    _httpx_client = httpx.AsyncClient(
+        timeout=5.0,
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20)
+    )
+
+    # Carregar o frontend para a memória
+    _load_static_cache()
+
+    # Abrir o SQLite (e migrar o JSON legado, se for a primeira vez)
+    await _init_db()
+
     # Se não houver produtos, adicionar exemplos
-    if not products_db:
+    async with _db.execute("SELECT COUNT(*) FROM products") as cursor:
+        total = (await cursor.fetchone())[0]
+    if total == 0:
         example_products = [
             {
                 "title": "NeuroSync v3",
@@ -387,26 +871,34 @@ async def startup_event():
             }
         ]
         
-        for product in example_products:
-            product["id"] = product_id_counter
-            products_db.append(product)
-            product_id_counter += 1
-        
-        # Salvar produtos de exemplo no arquivo
-        save_products(products_db, product_id_counter)
-
-@app.get("/api/buddy/speech")
-async def get_speech(text: str):
-    audio_data = await generate_speech(text)
-    return StreamingResponse(audio_data, media_type="audio/mpeg")
-
-# Rota para servir arquivos estáticos diretamente - IMPORTANTE: Colocar por último
-@app.get("/{file_path:path}")
-async def serve_static(file_path: str):
-    file_path = f"frontend/{file_path}"
-    if os.path.isfile(file_path):
-        return FileResponse(file_path)
-    return HTMLResponse(status_code=404)
+        await _seed_products_once(example_products)
+
+# Fechar a conexão com o banco e o cliente HTTP ao encerrar
+@app.on_event("shutdown")
+async def shutdown_event():
+    if _db:
+        await _db.close()
+    if _httpx_client:
+        await _httpx_client.aclose()
+    await OPENAI.close()
+
+# Servir o restante do frontend direto do Starlette (sendfile, sem passar
+# por código Python por requisição) - IMPORTANTE: Montar por último, depois
+# de todas as rotas da API
+app.mount("/", StaticFiles(directory="frontend", html=True), name="frontend")
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    if os.getenv("DEV"):
+        # Modo desenvolvimento: um worker com auto-reload
+        uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    else:
+        # Produção: um worker por núcleo, event loop uvloop (estado
+        # compartilhado já vive no SQLite; caches são por processo)
+        uvicorn.run(
+            "main:app",
+            host="0.0.0.0",
+            port=8000,
+            workers=os.cpu_count(),
+            loop="uvloop",
+            http="httptools"
+        )